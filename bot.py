@@ -1,11 +1,17 @@
 import os
+import re
 import logging
 import psycopg2
+import psycopg2.extensions
 import threading
-from datetime import datetime, timedelta
+from collections import defaultdict
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from web3 import Web3
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.request import Request
 from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
 
 # Load environment variables from .env file
@@ -17,6 +23,9 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 SHIBARIUM_NODE_URL = os.getenv("SHIBARIUM_NODE_URL")
 APP_NAME = os.getenv("APP_NAME")
 YOUR_ADMIN_USER_ID = os.getenv("YOUR_ADMIN_USER_ID")
+# Set when DATABASE_URL points at PgBouncer in transaction mode
+# (pool_mode=transaction, max_client_conn=500, default_pool_size=20)
+USE_PGBOUNCER = os.getenv("USE_PGBOUNCER", "").lower() in ("1", "true", "yes")
 
 # Setup logging
 logging.basicConfig(
@@ -26,14 +35,163 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Database setup
-conn = psycopg2.connect(DATABASE_URL)
-cursor = conn.cursor()
-
-# Web3 setup for Shibarium
-w3 = Web3(Web3.HTTPProvider(SHIBARIUM_NODE_URL))
+# Fixed-size pool: putconn closes connections beyond minconn, which would throw away
+# their prepared statements, so every connection is opened up front and kept.
+# The default leaves room under the 20-connection cap of the smallest Heroku Postgres
+# plans even while preboot runs the old and new dyno side by side.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+# Hot-path statements, PREPAREd once per pooled connection: name -> (parameter types, query)
+PREPARED_STATEMENTS = {
+    'register_user': ('bigint, bigint', "INSERT INTO users (user_id, token_balance) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING"),
+    'set_wallet': ('text, bigint', "UPDATE users SET wallet_address = $1 WHERE user_id = $2"),
+    'dashboard': ('bigint', "SELECT wallet_address, mining_power, token_balance, referral_count, joined_telegram, followed_twitter FROM users WHERE user_id = $1"),
+    # Tap and registration check in a single round-trip; referrer credit is batched separately.
+    # tap_timestamp is a UTC TIMESTAMP without time zone, as the original utcnow() writes were
+    'tap': ('bigint, integer, integer', '''
+        WITH tapped AS (
+            UPDATE users SET taps = CASE WHEN taps < $2 AND (now() AT TIME ZONE 'utc') - tap_timestamp < interval '1 day' THEN taps + 1 ELSE 1 END,
+                             tap_timestamp = (now() AT TIME ZONE 'utc'),
+                             token_balance = token_balance + ($3 * mining_power)
+            WHERE user_id = $1
+              AND (taps < $2 OR (now() AT TIME ZONE 'utc') - tap_timestamp > interval '1 day')
+            RETURNING referred_by, $3 * mining_power AS earned
+        )
+        SELECT (SELECT earned FROM tapped),
+               (SELECT referred_by FROM tapped),
+               EXISTS (SELECT 1 FROM users WHERE user_id = $1)
+    '''),
+}
+
+# Transaction pooling does not preserve session state, so behind PgBouncer the same
+# statements are sent inline with psycopg2 placeholders instead of PREPARE/EXECUTE
+INLINE_STATEMENTS = {
+    name: re.sub(r'\$(\d+)', r'%(p\1)s', query)
+    for name, (param_types, query) in PREPARED_STATEMENTS.items()
+}
+
+def execute_statement(cur, name, *args):
+    if USE_PGBOUNCER:
+        cur.execute(INLINE_STATEMENTS[name], {f'p{i}': arg for i, arg in enumerate(args, 1)})
+    else:
+        cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(args))})", args)
+
+class PreparedConnection(psycopg2.extensions.connection):
+    statements_prepared = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Every unit of work is a single statement, so skip the extra COMMIT round-trip
+        self.autocommit = True
+
+def prepare_statements(c):
+    with c.cursor() as cur:
+        # Clear anything left by an earlier attempt that failed partway; PREPARE is
+        # session state, so neither autocommit nor a rollback undoes it
+        cur.execute("DEALLOCATE ALL")
+        for name, (param_types, query) in PREPARED_STATEMENTS.items():
+            cur.execute(f"PREPARE {name} ({param_types}) AS {query}")
+    c.statements_prepared = True
+
+# Created by init_pool() once the dispatcher is set up, to keep startup light
+pool = None
+
+def init_pool():
+    global pool
+    pool = ThreadedConnectionPool(minconn=DB_POOL_SIZE, maxconn=DB_POOL_SIZE, dsn=DATABASE_URL,
+                                  connection_factory=PreparedConnection)
+
+@contextmanager
+def get_conn(prepare=True):
+    # Check out a pooled connection for the duration of a single handler
+    c = pool.getconn()
+    try:
+        if prepare and not USE_PGBOUNCER and not c.statements_prepared:
+            prepare_statements(c)
+        yield c
+    finally:
+        pool.putconn(c)
+
+# Short-lived per-user cache of dashboard rows; TTLCache is not thread-safe on its own
+DASH_CACHE = TTLCache(maxsize=10000, ttl=10)
+# Bumped on every invalidation so a read that raced with a write does not cache its stale row
+dash_generation = 0
+dash_cache_lock = threading.Lock()
+
+def invalidate_dashboard(user_id):
+    global dash_generation
+    with dash_cache_lock:
+        DASH_CACHE.pop(user_id, None)
+        dash_generation += 1
+
+# Credit many users in one multi-row UPDATE; pairs are (user_id or referral_code, amount)
+def bulk_credit(cur, pairs, key='user_id'):
+    if key not in ('user_id', 'referral_code'):
+        raise ValueError(f"Cannot credit users by {key}")
+    # UPDATE ... FROM applies only one matching VALUES row per user, so amounts for a repeated target are summed first
+    totals = defaultdict(int)
+    for target, amount in pairs:
+        totals[target] += amount
+    if not totals:
+        return
+    execute_values(
+        cur,
+        f"UPDATE users AS u SET token_balance = u.token_balance + d.amt FROM (VALUES %s) AS d(target, amt) WHERE u.{key} = d.target",
+        list(totals.items()),
+        page_size=len(totals)  # one statement, so a failure leaves nothing half-applied
+    )
+
+# Referrer bonuses are accumulated in memory and credited in one batched UPDATE
+REFERRAL_FLUSH_INTERVAL = 2  # seconds
+REFERRAL_FLUSH_THRESHOLD = 500  # pending referrers that trigger an early flush
+PENDING_REF = defaultdict(int)
+pending_ref_lock = threading.Lock()
+referral_flush_requested = threading.Event()
+referral_flush_stop = threading.Event()
+
+def queue_referral_credit(referral_code, amount):
+    with pending_ref_lock:
+        PENDING_REF[referral_code] += amount
+        backlog = len(PENDING_REF)
+    if backlog >= REFERRAL_FLUSH_THRESHOLD:
+        referral_flush_requested.set()
+
+def flush_referral_credits():
+    global PENDING_REF
+    with pending_ref_lock:
+        pending, PENDING_REF = PENDING_REF, defaultdict(int)
+    if not pending:
+        return
 
-# Global thread lock
-db_lock = threading.Lock()
+    try:
+        with get_conn() as c, c.cursor() as cur:
+            bulk_credit(cur, pending.items(), key='referral_code')
+    except psycopg2.Error as e:
+        logger.error("Failed to flush referral credits: %s", e)
+        # Put the credits back so the next flush retries them
+        for referral_code, amount in pending.items():
+            queue_referral_credit(referral_code, amount)
+
+def referral_flush_loop():
+    while not referral_flush_stop.is_set():
+        referral_flush_requested.wait(REFERRAL_FLUSH_INTERVAL)
+        referral_flush_requested.clear()
+        try:
+            flush_referral_credits()
+        except Exception:
+            # Keep the flusher alive; otherwise pending credits would never be written
+            logger.exception("Unexpected error while flushing referral credits")
+
+# Wallet address validation; web3 is only imported the first time a checksum needs verifying
+_ADDR_RE = re.compile(r'0x[0-9a-fA-F]{40}')
+_Web3 = None
+
+def is_checksum_address(wallet_address):
+    global _Web3
+    if _Web3 is None:
+        from web3 import Web3
+        _Web3 = Web3
+    return _Web3.isChecksumAddress(wallet_address)
 
 # Token distribution constants
 MAX_TAPS_PER_DAY = 10
@@ -47,8 +205,9 @@ REFERRAL_BONUS_PERCENTAGE = 0.10
 
 # Ensure necessary tables exist
 def ensure_tables_exist():
-    with db_lock:
-        cursor.execute('''
+    # Statements cannot be prepared until the table they reference exists
+    with get_conn(prepare=False) as c, c.cursor() as cur:
+        cur.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id SERIAL PRIMARY KEY,
                 wallet_address TEXT UNIQUE,
@@ -63,24 +222,23 @@ def ensure_tables_exist():
                 token_balance BIGINT DEFAULT 0  -- Changed to BIGINT for larger values
             )
         ''')
-        conn.commit()
+
+# Start menu, built once at import time
+WELCOME_MESSAGE = "Welcome to PartnerShib Bot! Please choose an option:"
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Tap", callback_data='tap')],
+    [InlineKeyboardButton("Skip Wallet Connection", callback_data='skip')],
+    [InlineKeyboardButton("Connect Wallet", callback_data='connect')],
+    [InlineKeyboardButton("Check Balance", callback_data='balance')],
+    [InlineKeyboardButton("Invite Friends", callback_data='invite')],
+    [InlineKeyboardButton("Join Telegram Group", url='https://www.t.me/shibariumpartnershib')],
+    [InlineKeyboardButton("Follow on Twitter", url='https://x.com/partnershib24')],
+    [InlineKeyboardButton("View Dashboard", callback_data='dashboard')]
+])
 
 # Command handlers
 def start(update: Update, context: CallbackContext):
-    keyboard = [
-        [InlineKeyboardButton("Tap", callback_data='tap')],
-        [InlineKeyboardButton("Skip Wallet Connection", callback_data='skip')],
-        [InlineKeyboardButton("Connect Wallet", callback_data='connect')],
-        [InlineKeyboardButton("Check Balance", callback_data='balance')],
-        [InlineKeyboardButton("Invite Friends", callback_data='invite')],
-        [InlineKeyboardButton("Join Telegram Group", url='https://www.t.me/shibariumpartnershib')],
-        [InlineKeyboardButton("Follow on Twitter", url='https://x.com/partnershib24')],
-        [InlineKeyboardButton("View Dashboard", callback_data='dashboard')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    welcome_message = "Welcome to PartnerShib Bot! Please choose an option:"
-    update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    update.message.reply_text(WELCOME_MESSAGE, reply_markup=START_KEYBOARD)
 
 def connect(update: Update, context: CallbackContext):
     query = update.callback_query
@@ -90,12 +248,9 @@ def skip(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
 
-    with db_lock:
-        cursor.execute(
-            "INSERT INTO users (user_id, token_balance) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING",
-            (user_id, BONUS_TOKENS)
-        )
-        conn.commit()
+    with get_conn() as c, c.cursor() as cur:
+        execute_statement(cur, 'register_user', user_id, BONUS_TOKENS)
+    invalidate_dashboard(user_id)
     
     query.message.reply_text("You have skipped wallet connection. You can still participate in other activities.")
 
@@ -103,29 +258,38 @@ def handle_wallet_address(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     wallet_address = update.message.text
 
-    if not Web3.isAddress(wallet_address):
+    # Cheap shape check first; only mixed-case addresses need the keccak checksum verification
+    hex_digits = wallet_address[2:]
+    if (not _ADDR_RE.fullmatch(wallet_address)
+            or (hex_digits != hex_digits.lower() and hex_digits != hex_digits.upper()
+                and not is_checksum_address(wallet_address))):
         update.message.reply_text("Invalid wallet address. Please try again.")
         return
 
-    with db_lock:
+    with get_conn() as c, c.cursor() as cur:
         try:
-            cursor.execute(
-                "UPDATE users SET wallet_address = %s WHERE user_id = %s",
-                (wallet_address, user_id)
-            )
-            conn.commit()
+            execute_statement(cur, 'set_wallet', wallet_address, user_id)
+            invalidate_dashboard(user_id)
             update.message.reply_text("Wallet connected successfully!")
         except psycopg2.IntegrityError as e:
-            conn.rollback()
-            logger.error(f"Integrity error: {e}")
+            logger.error("Integrity error: %s", e)
             update.message.reply_text("There was an error with connecting your wallet. Please try again.")
 
 def view_dashboard(update: Update, context: CallbackContext):
     user_id = update.callback_query.from_user.id
 
-    with db_lock:
-        cursor.execute("SELECT wallet_address, mining_power, token_balance, referral_count, joined_telegram, followed_twitter FROM users WHERE user_id = %s", (user_id,))
-        user = cursor.fetchone()
+    with dash_cache_lock:
+        user = DASH_CACHE.get(user_id)
+        generation = dash_generation
+
+    if user is None:
+        with get_conn() as c, c.cursor() as cur:
+            execute_statement(cur, 'dashboard', user_id)
+            user = cur.fetchone()
+        if user:
+            with dash_cache_lock:
+                if dash_generation == generation:
+                    DASH_CACHE[user_id] = user
 
     if user:
         wallet_address, mining_power, token_balance, referral_count, joined_telegram, followed_twitter = user
@@ -144,61 +308,65 @@ def view_dashboard(update: Update, context: CallbackContext):
 def handle_tap(update: Update, context: CallbackContext):
     user_id = update.callback_query.from_user.id
 
-    with db_lock:
-        cursor.execute("SELECT taps, tap_timestamp, mining_power FROM users WHERE user_id = %s", (user_id,))
-        user = cursor.fetchone()
+    with get_conn() as c, c.cursor() as cur:
+        execute_statement(cur, 'tap', user_id, MAX_TAPS_PER_DAY, TAP_REWARD)
+        new_tokens, referrer_code, registered = cur.fetchone()
+    invalidate_dashboard(user_id)
 
-    if user:
-        taps, tap_timestamp, mining_power = user
-        current_time = datetime.utcnow()
-
-        if taps < MAX_TAPS_PER_DAY or current_time - tap_timestamp > timedelta(days=1):
-            new_taps = taps + 1 if taps < MAX_TAPS_PER_DAY else 1
-            new_tokens = TAP_REWARD * mining_power
-
-            cursor.execute("UPDATE users SET taps = %s, tap_timestamp = %s, token_balance = token_balance + %s WHERE user_id = %s",
-                           (new_taps, current_time, new_tokens, user_id))
-            conn.commit()
-            update.callback_query.message.reply_text(f"Tapped! You received {new_tokens} tokens.")
-
-            # Update referrer's token balance
-            cursor.execute("SELECT referred_by FROM users WHERE user_id = %s", (user_id,))
-            referrer = cursor.fetchone()
-            if referrer and referrer[0]:
-                referrer_code = referrer[0]
-                referrer_bonus = new_tokens * REFERRAL_BONUS_PERCENTAGE
-
-                cursor.execute("UPDATE users SET token_balance = token_balance + %s WHERE referral_code = %s",
-                               (referrer_bonus, referrer_code))
-                conn.commit()
-                logger.debug(f"User {user_id}'s referrer {referrer_code} received {referrer_bonus} tokens")
-
-        else:
-            update.callback_query.message.reply_text("You have reached the maximum taps for today. Please try again tomorrow.")
-            logger.debug(f"User {user_id} reached maximum taps for today")
+    if new_tokens is not None:
+        update.callback_query.message.reply_text(f"Tapped! You received {new_tokens} tokens.")
+        if referrer_code:
+            referrer_bonus = new_tokens * REFERRAL_BONUS_PERCENTAGE
+            queue_referral_credit(referrer_code, referrer_bonus)
+            logger.debug("User %s's referrer %s received %s tokens", user_id, referrer_code, referrer_bonus)
+
+    elif registered:
+        update.callback_query.message.reply_text("You have reached the maximum taps for today. Please try again tomorrow.")
+        logger.debug("User %s reached maximum taps for today", user_id)
 
     else:
         update.callback_query.message.reply_text("You are not registered yet. Please use the /start command to register.")
-        logger.debug(f"User {user_id} is not registered")
+        logger.debug("User %s is not registered", user_id)
 
 # Main function to start the bot
 def main():
-    updater = Updater(token=TELEGRAM_BOT_TOKEN, use_context=True)
+    # Enough HTTPS connections for every worker to reply at once (PTB needs at least workers + 4)
+    request = Request(con_pool_size=32, connect_timeout=5, read_timeout=7)
+    bot = Bot(TELEGRAM_BOT_TOKEN, request=request)
+    # Handlers run concurrently on the dispatcher's worker threads, one pooled connection each;
+    # one connection is left over for the referral flusher
+    updater = Updater(bot=bot, use_context=True, workers=DB_POOL_SIZE - 1)
     dispatcher = updater.dispatcher
 
     # Command handlers
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_wallet_address))
-    dispatcher.add_handler(CallbackQueryHandler(connect, pattern='connect'))
-    dispatcher.add_handler(CallbackQueryHandler(skip, pattern='skip'))
-    dispatcher.add_handler(CallbackQueryHandler(handle_tap, pattern='tap'))
-    dispatcher.add_handler(CallbackQueryHandler(view_dashboard, pattern='dashboard'))
-
-    # Start the bot
-    updater.start_polling()
+    dispatcher.add_handler(CommandHandler("start", start, run_async=True))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_wallet_address, run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(connect, pattern='connect', run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(skip, pattern='skip', run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(handle_tap, pattern='tap', run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(view_dashboard, pattern='dashboard', run_async=True))
+
+    # Connect to the database only once the handlers are in place
+    init_pool()
+    ensure_tables_exist()
+
+    # Start the bot; on Heroku (PORT set) Telegram pushes updates to the webhook served on the dyno,
+    # elsewhere fall back to long polling that holds each getUpdates open until work arrives
+    if os.getenv("PORT"):
+        updater.start_webhook(listen="0.0.0.0", port=int(os.environ["PORT"]), url_path=TELEGRAM_BOT_TOKEN)
+        updater.bot.set_webhook(f"https://{APP_NAME}.herokuapp.com/{TELEGRAM_BOT_TOKEN}")
+    else:
+        updater.start_polling(timeout=30, poll_interval=0.0, read_latency=2.0)
+    flusher = threading.Thread(target=referral_flush_loop, daemon=True)
+    flusher.start()
     logger.debug("Bot started")
     updater.idle()
 
+    # Stop the flusher and wait for any in-flight batch, then credit whatever is still pending
+    referral_flush_stop.set()
+    referral_flush_requested.set()
+    flusher.join()
+    flush_referral_credits()
+
 if __name__ == '__main__':
-    ensure_tables_exist()
     main()